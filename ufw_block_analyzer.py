@@ -2,217 +2,510 @@
 """
 UFW Block Analyzer - Continuously monitors journalctl for UFW BLOCK messages.
 
-This script runs journalctl -f with grep to capture UFW BLOCK log entries,
-then parses each line using regex to extract key=value pairs and converts
-them into a dictionary with title case keys.
+This script runs journalctl -f with its native grep filter to capture UFW BLOCK
+log entries, then splits each line into KEY=VALUE tokens and stores the fields
+of interest in a slotted UFWBlock record (IN is stored as in_).
 
 Created with assistance from aider.chat
 """
 
 import json
+import os
 import re
+import select
 import subprocess
 import sys
+import time
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import click
 import rtoml
 from loguru import logger
 
-
-def get_docker_networks() -> Dict[str, Dict[str, str]]:
+# Marker identifying UFW BLOCK entries in the journal
+_BLOCK_MARKER = "[UFW BLOCK]"
+_BLOCK_MARKER_BYTES = _BLOCK_MARKER.encode("ascii")
+
+# UFW fields kept in the output, mapped from their log form to their UFWBlock
+# attribute so keys never need lowercasing. Technical fields (LEN, TTL, ...)
+# are dropped
+_KEEP = {
+    "IN": "in_",
+    "OUT": "out",
+    "PHYSIN": "physin",
+    "PHYSOUT": "physout",
+    "MAC": "mac",
+    "SRC": "src",
+    "DST": "dst",
+    "PROTO": "proto",
+    "SPT": "spt",
+    "DPT": "dpt",
+    "TYPE": "type",
+    "CODE": "code",
+}
+
+# Blocks arriving in a burst are logged together: a batch is flushed once the
+# pipe stays idle for _BATCH_WAIT seconds, its first record is older than
+# _BATCH_MAX_AGE seconds or it holds _BATCH_MAX records
+_BATCH_WAIT = 0.05
+_BATCH_MAX_AGE = 0.25
+_BATCH_MAX = 100
+
+
+def get_docker_networks(
+    is_refresh: bool = False,
+) -> Optional[Dict[str, Dict[str, str]]]:
     """
-    Get Docker network information using 'docker network ls --format json'.
+    Get Docker network information using 'docker network inspect'.
+
+    Lists all network IDs, then inspects them in a single call which returns
+    one JSON array with labels already parsed. Returns a dictionary mapping
+    network ID prefixes to network metadata including project names
+    extracted from Docker Compose labels.
 
-    Returns a dictionary mapping network ID prefixes to network metadata
-    including project names extracted from Docker Compose labels.
+    Parameters
+    ----------
+    is_refresh : bool
+        Whether this is a refresh while monitoring. Refreshes run sudo
+        non-interactively so an expired credential fails instead of waiting
+        for a password, and log at DEBUG to keep the console output clean.
 
     Returns
     -------
-    Dict[str, Dict[str, str]]
-        Dictionary mapping network ID prefixes to network info
+    Dict[str, Dict[str, str]] or None
+        Dictionary mapping network ID prefixes to network info, or None if
+        Docker could not be queried
     """
+    sudo = ["sudo", "-n"] if is_refresh else ["sudo"]
+    log_info = logger.debug if is_refresh else logger.info
+    log_error = logger.debug if is_refresh else logger.error
+
     try:
         result = subprocess.run(
-            ["sudo", "docker", "network", "ls", "--format", "json"],
+            [*sudo, "docker", "network", "ls", "-q", "--no-trunc"],
             capture_output=True,
             text=True,
             check=True,
         )
+        network_ids = result.stdout.split()
+        if not network_ids:
+            log_info("Loaded 0 Docker networks")
+            return {}
+
+        # A network removed since the listing makes inspect exit non-zero while
+        # still printing the others, so only an empty output counts as failure
+        result = subprocess.run(
+            [*sudo, "docker", "network", "inspect", *network_ids],
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+        if not result.stdout.strip():
+            raise subprocess.CalledProcessError(
+                result.returncode, result.args, result.stdout, result.stderr
+            )
+        if result.returncode != 0:
+            logger.debug(f"docker network inspect: {result.stderr.strip()}")
 
         networks = {}
-        for line in result.stdout.strip().split("\n"):
-            if line:
-                network = json.loads(line)
-                network_id = network.get("ID", "")
-                # Use first 12 characters of network ID for matching
-                network_prefix = network_id[:12]
-
-                # Extract project name from Docker Compose labels
-                labels = network.get("Labels", "")
-                project_name = "unknown"
-                if labels:
-                    for label in labels.split(","):
-                        if label.startswith("com.docker.compose.project="):
-                            project_name = label.split("=", 1)[1]
-                            break
-
-                networks[network_prefix] = {
-                    "name": network.get("Name", "unknown"),
-                    "project": project_name,
-                    "id": network_id,
-                }
-
-        logger.info(f"Loaded {len(networks)} Docker networks")
+        for network in json.loads(result.stdout):
+            network_id = network.get("Id", "")
+            # Use first 12 characters of network ID for matching
+            network_prefix = network_id[:12]
+
+            # Extract project name from Docker Compose labels
+            labels = network.get("Labels") or {}
+            networks[network_prefix] = {
+                "name": network.get("Name", "unknown"),
+                "project": labels.get("com.docker.compose.project", "unknown"),
+                "id": network_id,
+            }
+
+        log_info(f"Loaded {len(networks)} Docker networks")
         return networks
 
     except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to get Docker networks: {e}")
-        return {}
+        log_error(f"Failed to get Docker networks: {e}")
+        return None
     except Exception as e:
-        logger.error(f"Error parsing Docker networks: {e}")
-        return {}
+        log_error(f"Error parsing Docker networks: {e}")
+        return None
+
+
+class DockerNetworkCache:
+    """
+    Docker network map that refreshes itself when an unknown bridge shows up.
+
+    Networks created after startup would otherwise never be matched. Since
+    querying Docker is slow, a refresh happens at most once per min_interval
+    seconds and only on a lookup miss.
+
+    Parameters
+    ----------
+    min_interval : float
+        Minimum number of seconds between two refreshes
+    """
+
+    def __init__(self, min_interval: float = 30.0) -> None:
+        self.min_interval = min_interval
+        self.networks: Dict[str, Dict[str, str]] = {}
+        self.last_refresh_ts = 0.0
+        self.refresh(is_refresh=False)
+
+    def refresh(self, is_refresh: bool = True) -> None:
+        """
+        Reload the network map from Docker, keeping the old one on failure.
+
+        Parameters
+        ----------
+        is_refresh : bool
+            False for the initial load at startup, which may prompt for a
+            sudo password and logs at INFO
+        """
+        networks = get_docker_networks(is_refresh=is_refresh)
+        if networks is not None:
+            self.networks = networks
+        self.last_refresh_ts = time.monotonic()
+
+    def get(self, network_prefix: str) -> Optional[Dict[str, str]]:
+        """
+        Look up a network by its 12 character ID prefix.
+
+        Parameters
+        ----------
+        network_prefix : str
+            First 12 characters of the Docker network ID
+
+        Returns
+        -------
+        Dict[str, str] or None
+            Network metadata, or None if still unknown after a possible refresh
+        """
+        net_info = self.networks.get(network_prefix)
+        if net_info is None:
+            if time.monotonic() - self.last_refresh_ts > self.min_interval:
+                logger.debug(f"Unknown Docker network {network_prefix}, refreshing")
+                self.refresh()
+                net_info = self.networks.get(network_prefix)
+        return net_info
+
+
+class UFWBlock:
+    """
+    Parsed UFW BLOCK entry with a fixed set of fields.
+
+    Uses __slots__ instead of a per-record dict, which keeps batches of
+    records small. Fields absent from the log line stay None and are left
+    out of the output. The trailing underscore of in_ avoids the keyword
+    and is dropped in the output.
+    """
+
+    __slots__ = (
+        "in_",
+        "out",
+        "physin",
+        "physout",
+        "mac",
+        "src",
+        "dst",
+        "proto",
+        "spt",
+        "dpt",
+        "type",
+        "code",
+        "docker_project",
+        "docker_network",
+    )
+
+    in_: Optional[str]
+    out: Optional[str]
+    physin: Optional[str]
+    physout: Optional[str]
+    mac: Optional[str]
+    src: Optional[str]
+    dst: Optional[str]
+    proto: Optional[str]
+    spt: Optional[str]
+    dpt: Optional[str]
+    type: Optional[str]
+    code: Optional[str]
+    docker_project: Optional[str]
+    docker_network: Optional[str]
+
+    def __init__(self) -> None:
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    def fields(self) -> Iterator[Tuple[str, str]]:
+        """
+        Iterate over the set fields in output order.
+
+        Yields
+        ------
+        Tuple[str, str]
+            Output field name and its value
+        """
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                yield name.rstrip("_"), value
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={value!r}" for name, value in self.fields())
+        return f"UFWBlock({fields})"
 
 
 def parse_ufw_block_line(
-    line: str, docker_networks: Dict[str, Dict[str, str]]
-) -> Optional[Dict[str, str]]:
+    line: str, docker_networks: Optional[DockerNetworkCache] = None
+) -> Optional[UFWBlock]:
     """
     Parse a UFW BLOCK log line and extract key=value pairs with Docker network info.
 
-    Uses regex to find all KEY=VALUE patterns in the line and converts
-    keys to lowercase. Matches interface names to Docker networks and
-    adds project information. Removes unnecessary technical fields.
+    Splits the line on whitespace and keeps the KEY=VALUE tokens for
+    interfaces, addresses, protocol, ports and ICMP type/code. Matches
+    interface names to Docker networks and adds project information.
 
     Parameters
     ----------
     line : str
         The UFW BLOCK log line to parse
-    docker_networks : Dict[str, Dict[str, str]]
-        Dictionary mapping network ID prefixes to network metadata
+    docker_networks : DockerNetworkCache, optional
+        Docker network map keyed by network ID prefix. If None, the Docker
+        fields are not added.
 
     Returns
     -------
-    Dict[str, str] or None
-        Dictionary with lowercase keys and string values, or None if no UFW BLOCK found
+    UFWBlock or None
+        Parsed entry, or None if no known UFW fields found
     """
-    # Only process lines that contain UFW BLOCK
-    if "[UFW BLOCK]" not in line:
-        return None
-
-    # Regex pattern to match KEY=VALUE pairs
-    pattern = r"([A-Z]+)=([^\s]*)"
-    matches = re.findall(pattern, line)
-
-    if not matches:
-        logger.warning(f"No key=value pairs found in line: {line.strip()}")
+    # UFW lines are space separated KEY=VALUE tokens, so plain string splitting
+    # is enough. Only whitelisted fields are kept
+    block = UFWBlock()
+    found = False
+    for token in line.split():
+        key, sep, value = token.partition("=")
+        name = _KEEP.get(key)
+        if name is not None and sep:
+            setattr(block, name, value)
+            found = True
+
+    if not found:
+        logger.warning(f"No known UFW fields found in line: {line.strip()}")
         return None
 
-    # Convert to dictionary with lowercase keys
-    parsed_data = {}
-    for key, value in matches:
-        parsed_data[key.lower()] = value
+    if docker_networks is None:
+        return block
 
-    # Match interface to Docker network and add project info
-    interface = parsed_data.get("in") or parsed_data.get("out", "")
+    # Match interface to Docker network and add project info.
+    # Docker fields are set for all interfaces to ensure consistency
+    interface = block.in_ or block.out
 
-    # Initialize Docker fields for all interfaces to ensure consistency
-    parsed_data["docker_project"] = "not_docker"
-    parsed_data["docker_network"] = "not_docker"
-
-    # Only process Docker bridge interfaces (br-*)
+    # Only look up Docker bridge interfaces (br-*)
     if interface and interface.startswith("br-"):
-        network_id = interface[3:]  # Remove 'br-' prefix
-        # Search for matching Docker network
-        for net_prefix, net_info in docker_networks.items():
-            if network_id.startswith(net_prefix):
-                parsed_data["docker_project"] = net_info["project"]
-                parsed_data["docker_network"] = net_info["name"]
-                break
+        # Docker bridge names carry the first 12 characters of the network ID,
+        # which is exactly how docker_networks is keyed. Shorter names cannot
+        # be Docker bridges, so they skip the lookup and a pointless refresh
+        net_info = (
+            docker_networks.get(interface[3:15]) if len(interface) >= 15 else None
+        )
+        if net_info is not None:
+            block.docker_project = net_info["project"]
+            block.docker_network = net_info["name"]
         else:
             # Docker bridge interface but no matching network found
-            parsed_data["docker_project"] = "unknown"
-            parsed_data["docker_network"] = "unknown"
+            block.docker_project = "unknown"
+            block.docker_network = "unknown"
+    else:
+        block.docker_project = "not_docker"
+        block.docker_network = "not_docker"
+
+    return block
+
+
+def format_ufw_block(block: UFWBlock) -> str:
+    """
+    Format a parsed UFW BLOCK entry as unquoted TOML key = value lines.
+
+    UFW field values are plain ASCII tokens, so each line is emitted directly
+    instead of going through a full TOML serializer. Falls back to rtoml when
+    a value would need escaping.
+
+    Parameters
+    ----------
+    block : UFWBlock
+        Entry returned by parse_ufw_block_line
+
+    Returns
+    -------
+    str
+        TOML formatted output with quotation marks stripped
+    """
+    fields = list(block.fields())
+    if any('"' in value or "\\" in value for _, value in fields):
+        return rtoml.dumps(dict(fields)).replace('"', "")
+    return "\n".join(f"{name} = {value}" for name, value in fields)
 
-    # Remove unwanted technical fields
-    keys_to_remove = ["len", "tos", "prec", "id", "ttl", "window", "res", "urgp"]
-    for key in keys_to_remove:
-        parsed_data.pop(key, None)
 
-    return parsed_data
+def log_ufw_blocks(blocks: List[UFWBlock]) -> None:
+    """
+    Log a batch of parsed UFW BLOCK entries as a single record.
+
+    Parameters
+    ----------
+    blocks : List[UFWBlock]
+        Entries returned by parse_ufw_block_line
+    """
+    formatted_output = "\n---\n".join(format_ufw_block(block) for block in blocks)
+    logger.info(f"UFW Blocks detected ({len(blocks)}):\n{formatted_output}")
 
 
-def run_ufw_monitor(verbose: bool, docker_networks: Dict[str, Dict[str, str]]) -> None:
+def run_ufw_monitor(
+    verbose: bool, docker_networks: Optional[DockerNetworkCache]
+) -> None:
     """
     Continuously monitor journalctl for UFW BLOCK messages.
 
-    Uses subprocess.Popen to run journalctl -f to monitor UFW BLOCK messages.
+    Uses subprocess.Popen to run journalctl -f, letting journalctl itself
+    filter for UFW BLOCK messages so unrelated lines never reach the pipe.
     Enriches each blocked connection with Docker network information.
+    Blocks read in the same burst are logged together.
 
     Parameters
     ----------
     verbose : bool
-        Whether to print captured lines
-    docker_networks : Dict[str, Dict[str, str]]
-        Dictionary mapping network ID prefixes to network metadata
+        Whether to print each captured UFW BLOCK line
+    docker_networks : DockerNetworkCache, optional
+        Docker network map keyed by network ID prefix, or None to skip
+        Docker enrichment
     """
     logger.info("Starting UFW block analyzer...")
     logger.info("Monitoring journalctl for UFW BLOCK messages...")
 
+    batch: List[UFWBlock] = []
+    batch_start = 0.0
+
     try:
-        # Run journalctl -f
-        # We use shell=True here to easily chain the commands with pipe
+        # Follow new entries only (-n 0), print just the message (--output=cat)
+        # and let journalctl do the filtering instead of piping through grep
         process = subprocess.Popen(
-            "journalctl -f",
-            shell=True,
+            [
+                "journalctl",
+                "-f",
+                "-g",
+                re.escape(_BLOCK_MARKER),
+                "--output=cat",
+                "-n",
+                "0",
+            ],
+            shell=False,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-            bufsize=1,  # Line buffered for real-time output
+            # Never drained, so a pipe here could fill up and block journalctl
+            stderr=subprocess.DEVNULL,
+            bufsize=0,  # Unbuffered, chunks are read straight from the fd below
         )
 
         logger.info("Successfully started journalctl monitoring")
 
-        # Process each line as it comes in
-        for line in iter(process.stdout.readline, ""):
-            if line:
+        stdout_fd = process.stdout.fileno()
+        pending = b""
+
+        # Process whatever is available on the pipe, one chunk at a time
+        while True:
+            chunk = os.read(stdout_fd, 65536)
+            if chunk:
+                # The last element is an incomplete line kept for the next chunk
+                *raw_lines, pending = (pending + chunk).split(b"\n")
+            else:
+                # EOF: a final line without trailing newline is still processed
+                raw_lines, pending = [pending], b""
+
+            for raw in raw_lines:
+                # Check the marker on raw bytes so other lines are never decoded
+                if _BLOCK_MARKER_BYTES not in raw:
+                    continue
+
+                # UFW log content is plain ASCII, which makes this the cheapest decode
+                line = raw.decode("ascii", "replace")
                 if verbose:
-                    print(f"Captured line: {line.strip()}")
+                    print("Captured line:", line)
 
-                parsed_data = parse_ufw_block_line(line.strip(), docker_networks)
-                if parsed_data:
-                    formatted_output = rtoml.dumps(parsed_data)
-                    # Strip quotation marks from the TOML output
-                    formatted_output = formatted_output.replace('"', "")
-                    logger.info(f"UFW Block detected:\n{formatted_output}")
+                block = parse_ufw_block_line(line, docker_networks)
+                if block is not None:
+                    if not batch:
+                        batch_start = time.monotonic()
+                    batch.append(block)
+
+            if not chunk:
+                break
+
+            # Keep reading while the burst lasts, then log it in one go
+            if batch and (
+                len(batch) >= _BATCH_MAX
+                or time.monotonic() - batch_start >= _BATCH_MAX_AGE
+                or not select.select([stdout_fd], [], [], _BATCH_WAIT)[0]
+            ):
+                log_ufw_blocks(batch)
+                batch = []
+
+        if batch:
+            log_ufw_blocks(batch)
+
+        logger.warning(f"journalctl exited with code {process.wait()}")
 
     except KeyboardInterrupt:
         logger.info("Received interrupt signal, stopping monitor...")
+        if batch:
+            log_ufw_blocks(batch)
         if "process" in locals():
             process.terminate()
         sys.exit(0)
 
     except Exception as e:
         logger.error(f"Error running UFW monitor: {e}")
+        if "process" in locals():
+            logger.error(f"journalctl exit code: {process.poll()}")
         sys.exit(1)
 
 
 @click.command()
-@click.option("--verbose", is_flag=True, help="Print captured lines")
-def main(verbose: bool) -> None:
+@click.option(
+    "--verbose", is_flag=True, help="Print each captured UFW BLOCK journal line"
+)
+@click.option(
+    "--no-docker", is_flag=True, help="Skip Docker network enrichment entirely"
+)
+def main(verbose: bool, no_docker: bool) -> None:
     """UFW Block Analyzer - Monitor and analyze UFW BLOCK messages with Docker context."""
-    # Configure loguru to output to stderr so it doesn't interfere with data output
+    # Configure loguru to output to stderr so it doesn't interfere with data output.
+    # enqueue=True hands records to a worker thread so writes never block the
+    # journalctl reader, the bare message format skips timestamp and location
+    # formatting, and disabling backtrace/diagnose avoids frame introspection
     logger.remove()
-    logger.add(sys.stderr, level="INFO")
+    logger.add(
+        sys.stderr,
+        level="INFO",
+        format="{message}",
+        enqueue=True,
+        backtrace=False,
+        diagnose=False,
+    )
 
     # Add DEBUG level logging to a file next to the script
     script_dir = Path(__file__).parent
     log_file = script_dir / "ufw_block_analyzer.log"
-    logger.add(log_file, level="DEBUG", rotation="10 MB", retention="7 days")
-
-    # Get Docker networks once at startup
-    docker_networks = get_docker_networks()
+    logger.add(
+        log_file,
+        level="DEBUG",
+        rotation="10 MB",
+        retention="7 days",
+        enqueue=True,
+        backtrace=False,
+        diagnose=False,
+    )
+
+    # Get Docker networks at startup, refreshed later when unknown bridges appear
+    docker_networks = None if no_docker else DockerNetworkCache()
 
     run_ufw_monitor(verbose=verbose, docker_networks=docker_networks)
 